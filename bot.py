@@ -1,9 +1,12 @@
 # bot.py
 import os
 import asyncio
-import json
 import logging
-from typing import Any, Dict, List, Optional, Set
+import signal
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set
 
 from dotenv import load_dotenv
 
@@ -13,9 +16,14 @@ from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.exceptions import TelegramBadRequest
 
-from anthropic import Anthropic
+import aiosqlite
+import orjson
+from anthropic import AsyncAnthropic
 
+import anyio
+import httpx
 from fastmcp import Client  # FastMCP client
+from fastmcp.client.transports import SSETransport, StreamableHttpTransport
 
 
 load_dotenv()
@@ -26,6 +34,18 @@ def _get_env(key: str, default: Optional[str] = None) -> Optional[str]:
         return None
     return value.strip()
 
+def _parse_float(raw: Optional[str], default: float) -> float:
+    try:
+        return float(raw) if raw not in (None, "") else default
+    except ValueError:
+        return default
+
+def _parse_int(raw: Optional[str], default: int) -> int:
+    try:
+        return int(raw) if raw not in (None, "") else default
+    except ValueError:
+        return default
+
 
 LOG_LEVEL = (_get_env("LOG_LEVEL", "INFO") or "INFO").upper()
 logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO))
@@ -35,9 +55,26 @@ TELEGRAM_BOT_TOKEN = _get_env("TELEGRAM_BOT_TOKEN")
 ANTHROPIC_API_KEY = _get_env("ANTHROPIC_API_KEY")
 CLAUDE_MODEL = _get_env("CLAUDE_MODEL", "claude-sonnet-4-5") or "claude-sonnet-4-5"
 SYSTEM_PROMPT = _get_env("SYSTEM_PROMPT") or ""
+MAX_HISTORY = _parse_int(_get_env("MAX_HISTORY"), 20)
+MAX_USER_CHARS = _parse_int(_get_env("MAX_USER_CHARS"), 8000)
+# On SIGTERM, how long in-flight answers may finish before they are cancelled.
+SHUTDOWN_GRACE_SECONDS = _parse_float(_get_env("SHUTDOWN_GRACE_SECONDS"), 8.0)
+COALESCE_MS = _parse_int(_get_env("COALESCE_MS"), 0)
+HISTORY_DB_PATH = _get_env("HISTORY_DB_PATH") or ""
+HISTORY_LRU = _parse_int(_get_env("HISTORY_LRU"), 1024)
 _allowed_ids_raw = _get_env("TELEGRAM_ALLOWED_USER_IDS", "") or ""
 
 MCP_SERVER_URL = _get_env("MCP_SERVER_URL")
+MCP_TOOLS_TTL_SECONDS = _parse_float(_get_env("MCP_TOOLS_TTL_SECONDS"), 300.0)
+MCP_KEEPALIVE_SECONDS = _parse_float(_get_env("MCP_KEEPALIVE_SECONDS"), 0.0)
+
+# Pool limits used by both the Anthropic and the MCP HTTP clients (each client has
+# its own pool); httpx's defaults (10 keep-alive / 100 total) starve under concurrent chats.
+HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=_parse_int(_get_env("HTTP_MAX_KEEPALIVE"), 64),
+    max_connections=_parse_int(_get_env("HTTP_MAX_CONNECTIONS"), 256),
+    keepalive_expiry=_parse_float(_get_env("HTTP_KEEPALIVE_EXPIRY"), 60.0),
+)
 
 
 def _normalize_mcp_auth(raw_auth: Optional[str]) -> Optional[str]:
@@ -62,114 +99,188 @@ MCP_AUTH = _normalize_mcp_auth(_get_env("MCP_AUTH"))
 if not TELEGRAM_BOT_TOKEN or not ANTHROPIC_API_KEY or not MCP_SERVER_URL:
     raise RuntimeError("Missing required env vars. Check TELEGRAM_BOT_TOKEN, ANTHROPIC_API_KEY, MCP_SERVER_URL")
 
-def _parse_allowed_ids(raw: str) -> Set[int]:
-    ids: Set[int] = set()
-    if not raw:
-        return ids
-    for chunk in raw.split(","):
-        candidate = chunk.strip()
-        if not candidate:
-            continue
-        try:
-            ids.add(int(candidate))
-        except ValueError:
+def _parse_allowed_ids(raw: str) -> FrozenSet[int]:
+    candidates = [chunk.strip() for chunk in raw.split(",") if chunk.strip()]
+    valid = [c for c in candidates if c.removeprefix("-").isdecimal()]
+    for candidate in candidates:
+        if not candidate.removeprefix("-").isdecimal():
             logger.warning("Ignoring invalid TELEGRAM_ALLOWED_USER_IDS entry: %r", candidate)
-    return ids
+    return frozenset(int(c) for c in valid)
 
 
 ALLOWED_TELEGRAM_USER_IDS = _parse_allowed_ids(_allowed_ids_raw)
 
-def _is_user_allowed(user_id: int) -> bool:
-    return not ALLOWED_TELEGRAM_USER_IDS or user_id in ALLOWED_TELEGRAM_USER_IDS
+
+def _build_user_check(allowed: FrozenSet[int]) -> Callable[[int], bool]:
+    # Runs on every update: bind the frozenset's membership test directly.
+    if not allowed:
+        return lambda user_id: True
+    return allowed.__contains__
+
+
+_is_user_allowed = _build_user_check(ALLOWED_TELEGRAM_USER_IDS)
 
 
 # -------------------------
 # MCP bridge (FastMCP client)
 # -------------------------
+def _mcp_http_client(
+    headers: Optional[Dict[str, str]] = None,
+    timeout: Optional[httpx.Timeout] = None,
+    auth: Optional[httpx.Auth] = None,
+) -> httpx.AsyncClient:
+    """httpx client factory for FastMCP transports using the tuned HTTP_LIMITS pool."""
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout or httpx.Timeout(30.0, read=300.0),
+        auth=auth,
+        limits=HTTP_LIMITS,
+        follow_redirects=True,
+    )
+
+
 class MCPBridge:
+    # Errors that mean the underlying MCP session is gone and worth a reconnect.
+    RECONNECT_ERRORS = (
+        ConnectionError,
+        httpx.RemoteProtocolError,
+        httpx.ConnectError,
+        anyio.ClosedResourceError,
+        anyio.BrokenResourceError,
+    )
+    RECONNECT_RETRIES = 2
+
     def __init__(self, url: str, auth: Optional[str] = None):
         self.url = url
         self.auth = auth
-        self.client = Client(url, auth=auth) if auth else Client(url)
+        transport_cls = SSETransport if url.rstrip("/").endswith("/sse") else StreamableHttpTransport
+        self.client = Client(transport_cls(url, auth=auth, httpx_client_factory=_mcp_http_client))
         self._connected = False
+        self._conn_lock = asyncio.Lock()
+        self._conn_generation = 0  # bumped on every (re)connect
+        self._keepalive_task: Optional[asyncio.Task] = None
         self._cached_tools = None  # list[mcp.types.Tool]
+        # Claude-formatted tool schemas, reused across turns until the TTL expires
+        self._schemas_cache: Optional[List[Dict[str, Any]]] = None
+        self._schemas_expiry = 0.0
+        self._schemas_lock = asyncio.Lock()
 
     async def connect(self):
+        async with self._conn_lock:
+            await self._open()
+        if MCP_KEEPALIVE_SECONDS > 0 and self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive())
+
+    async def close(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            await asyncio.gather(self._keepalive_task, return_exceptions=True)
+            self._keepalive_task = None
+        async with self._conn_lock:
+            await self._shutdown()
+
+    async def _open(self):
         if not self._connected:
             await self.client.__aenter__()
             self._connected = True
+            self._conn_generation += 1
 
-    async def close(self):
+    async def _shutdown(self):
         if self._connected:
-            await self.client.__aexit__(None, None, None)
             self._connected = False
+            try:
+                await self.client.__aexit__(None, None, None)
+            except Exception:
+                logger.warning("Error while closing MCP session", exc_info=True)
+
+    async def _reconnect(self, seen_generation: int):
+        async with self._conn_lock:
+            # Another caller already replaced the session this one failed on.
+            if self._connected and self._conn_generation != seen_generation:
+                return
+            await self._shutdown()
+            await self._open()
+
+    async def _with_reconnect(self, fn, *args):
+        for attempt in range(self.RECONNECT_RETRIES + 1):
+            generation = self._conn_generation
+            try:
+                # An earlier reconnect may have failed and left the session closed.
+                if not self._connected:
+                    async with self._conn_lock:
+                        await self._open()
+                generation = self._conn_generation
+                return await fn(*args)
+            except self.RECONNECT_ERRORS as exc:
+                if attempt >= self.RECONNECT_RETRIES:
+                    raise
+                delay = 0.5 * (2 ** attempt)
+                logger.warning("MCP connection lost (%r); reconnecting in %.1fs", exc, delay)
+                await asyncio.sleep(delay)
+                try:
+                    await self._reconnect(generation)
+                except Exception:
+                    # Server still down; the next attempt (or call) opens a fresh session.
+                    logger.warning("MCP reconnect failed", exc_info=True)
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(MCP_KEEPALIVE_SECONDS)
+            try:
+                await self._with_reconnect(self.client.ping)
+            except Exception:
+                logger.warning("MCP keepalive ping failed", exc_info=True)
 
     async def list_tools(self):
         # FastMCP supports list_tools() when connected. :contentReference[oaicite:6]{index=6}
-        self._cached_tools = await self.client.list_tools()
+        self._cached_tools = await self._with_reconnect(self.client.list_tools)
         return self._cached_tools
 
     async def call_tool(self, name: str, arguments: Dict[str, Any]):
         # call_tool() executes the MCP tool. :contentReference[oaicite:7]{index=7}
-        return await self.client.call_tool(name, arguments)
-
-    async def claude_tool_schemas_old(self):
-        """
-        Convert MCP tool definitions to Claude tool JSON Schemas.
-        Claude expects: [{name, description, input_schema}, ...] :contentReference[oaicite:8]{index=8}
-        """
-        tools = await self.list_tools()
-        schemas = []
-        for t in tools:
-            # Be defensive about attribute names across SDK versions
-            name = getattr(t, "name", None)
-            desc = getattr(t, "description", "") or ""
-            input_schema = (
-                getattr(t, "input_schema", None)
-                or getattr(t, "inputSchema", None)
-                or {}
-            )
-            if not name:
-                continue
+        try:
+            return await self._with_reconnect(self.client.call_tool, name, arguments)
+        except Exception as exc:
+            # The server-side tool list changed under us; refetch on the next turn.
+            if "unknown tool" in str(exc).lower():
+                self.invalidate_tools()
+            raise
 
-            schemas.append(
-                {
-                    "name": name,
-                    "description": desc,
-                    "input_schema": input_schema,
-                }
-            )
-        return schemas
+    def invalidate_tools(self):
+        self._schemas_cache = None
+        self._schemas_expiry = 0.0
 
     async def claude_tool_schemas(self):
         """
         Use MCP inputSchema as-is, only convert casing for Claude.
         This ensures Claude will emit {"input": {...}} which your tools require.
+        Results are cached for MCP_TOOLS_TTL_SECONDS since tool lists rarely change.
         """
+        if self._schemas_cache is not None and time.monotonic() < self._schemas_expiry:
+            return self._schemas_cache
+
+        async with self._schemas_lock:
+            if self._schemas_cache is not None and time.monotonic() < self._schemas_expiry:
+                return self._schemas_cache
+            schemas = await self._build_tool_schemas()
+            self._schemas_cache = schemas
+            self._schemas_expiry = time.monotonic() + MCP_TOOLS_TTL_SECONDS
+            return schemas
+
+    async def _build_tool_schemas(self):
         tools = await self.list_tools()
         schemas = []
 
         for t in tools:
-            # FastMCP Tool objects can expose either snake or camel fields depending on version.
-            name = getattr(t, "name", None) or t.get("name")
-            desc = getattr(t, "description", "") or t.get("description", "")
-
-            # MCP uses inputSchema; Claude wants input_schema
-            input_schema = (
-                getattr(t, "inputSchema", None)
-                or getattr(t, "input_schema", None)
-                or t.get("inputSchema")
-                or t.get("input_schema")
-                or {}
-            )
-
-            if not name:
+            # FastMCP returns pydantic mcp.types.Tool models (no dict .get fallback).
+            if not t.name:
                 continue
 
             schemas.append({
-                "name": name,
-                "description": desc,
-                "input_schema": input_schema,   # NOTE: keep wrapper "input"
+                "name": t.name,
+                "description": t.description or "",
+                # MCP uses inputSchema; Claude wants input_schema
+                "input_schema": t.inputSchema or {},   # NOTE: keep wrapper "input"
             })
 
         return schemas
@@ -180,10 +291,118 @@ mcp_bridge = MCPBridge(MCP_SERVER_URL, MCP_AUTH)
 # -------------------------
 # Claude tool-calling loop
 # -------------------------
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+anthropic_client = AsyncAnthropic(
+    api_key=ANTHROPIC_API_KEY,
+    http_client=httpx.AsyncClient(limits=HTTP_LIMITS, timeout=httpx.Timeout(120.0, connect=10.0)),
+)
+
+def _starts_turn(message: Dict[str, Any]) -> bool:
+    # A plain user prompt; tool_result messages can't lead because their tool_use would be gone.
+    return message["role"] == "user" and isinstance(message["content"], str)
+
+
+def _trim_history(history: List[Dict[str, Any]], max_messages: int) -> List[Dict[str, Any]]:
+    """
+    Keep the newest whole turns that fit in max_messages, so the history never
+    starts with an orphaned tool_result or assistant message. The latest turn is
+    always kept, even when it alone is longer than the limit.
+    """
+    starts = [i for i, message in enumerate(history) if _starts_turn(message)]
+    if not starts:
+        return []
+    cutoff = len(history) - max_messages
+    return history[next((i for i in starts if i >= cutoff), starts[-1]):]
+
+
+class HistoryStore:
+    """
+    Per-chat history: an in-RAM LRU of the most recently active chats, optionally
+    backed by SQLite (HISTORY_DB_PATH) so context survives restarts. Each process
+    serves its own cached copy, so one file must not be shared by several workers.
+    """
+
+    def __init__(self, db_path: str = "", max_messages: int = 20, lru_size: int = 1024):
+        self.db_path = db_path
+        self.max_messages = max_messages
+        self.lru_size = lru_size
+        self._cache: "OrderedDict[int, List[Dict[str, Any]]]" = OrderedDict()
+        self._db = None
+
+    async def open(self):
+        if not self.db_path or self._db is not None:
+            return
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS histories ("
+            "chat_id INTEGER PRIMARY KEY, history BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+        await self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def get(self, chat_id: int) -> List[Dict[str, Any]]:
+        history = self._cache.get(chat_id)
+        if history is not None:
+            self._cache.move_to_end(chat_id)
+            return history
+
+        history: List[Dict[str, Any]] = []
+        if self._db is not None:
+            async with self._db.execute("SELECT history FROM histories WHERE chat_id = ?", (chat_id,)) as cur:
+                row = await cur.fetchone()
+            if row:
+                # Trim again: rows written before whole-turn trimming may start mid-turn.
+                history = _trim_history(orjson.loads(row[0]), self.max_messages)
+        self._remember(chat_id, history)
+        return history
+
+    async def put(self, chat_id: int, history: List[Dict[str, Any]]):
+        history = _trim_history(history, self.max_messages)
+        self._remember(chat_id, history)
+        if self._db is not None:
+            await self._db.execute(
+                "INSERT OR REPLACE INTO histories (chat_id, history, updated_at) VALUES (?, ?, ?)",
+                (chat_id, orjson.dumps(history), time.time()),
+            )
+            await self._db.commit()
+
+    def _remember(self, chat_id: int, history: List[Dict[str, Any]]):
+        self._cache[chat_id] = history
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.lru_size:
+            self._cache.popitem(last=False)
+
 
 # per-chat state (simple memory)
-histories: Dict[int, List[Dict[str, Any]]] = {}
+history_store = HistoryStore(HISTORY_DB_PATH, MAX_HISTORY, HISTORY_LRU)
+
+# per-chat locks so turns from the same chat never interleave on its history;
+# weak values let idle chats' locks be garbage collected
+chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        chat_locks[chat_id] = lock
+    return lock
+
+# texts received for a chat that have not been sent to Claude yet
+pending_texts: Dict[int, List[str]] = {}
+
+
+async def _keep_typing(chat: types.Chat) -> None:
+    """Telegram hides the typing indicator after ~5s; refresh it until cancelled."""
+    while True:
+        try:
+            await chat.do("typing")
+        except Exception:
+            logger.debug("Failed to send typing action", exc_info=True)
+        await asyncio.sleep(4)
 
 
 async def _safe_markdown_reply(message: types.Message, text: str) -> types.Message:
@@ -201,6 +420,72 @@ async def _safe_markdown_reply(message: types.Message, text: str) -> types.Messa
         return await message.reply(text, parse_mode=None)
 
 
+def _dumps(obj: Any) -> str:
+    # orjson always emits UTF-8 (same as ensure_ascii=False); its encode error is a TypeError.
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _as_dict(block: Any) -> Dict[str, Any]:
+    """Normalize an SDK content block (pydantic model or dict) to a plain dict once."""
+    if hasattr(block, "model_dump"):
+        return block.model_dump()
+    if isinstance(block, dict):
+        return block
+    return {
+        "type": getattr(block, "type", None),
+        "text": getattr(block, "text", None),
+        "name": getattr(block, "name", None),
+        "input": getattr(block, "input", None),
+        "id": getattr(block, "id", None),
+    }
+
+
+def _to_text_segment(segment: Any) -> Dict[str, Any]:
+    # Fast path: TextContent (or an equivalent dict) already carries the string we need.
+    if isinstance(segment, dict):
+        if segment.get("type") == "text" and "text" in segment:
+            return {"type": "text", "text": str(segment["text"])}
+    else:
+        text = getattr(segment, "text", None)
+        if isinstance(text, str) and getattr(segment, "type", None) == "text":
+            return {"type": "text", "text": text}
+    if isinstance(segment, str):
+        return {"type": "text", "text": segment}
+    if isinstance(segment, dict) or hasattr(segment, "model_dump"):
+        seg = _as_dict(segment)
+        if seg.get("type") == "text" and "text" in seg:
+            return {"type": "text", "text": str(seg["text"])}
+        try:
+            return {"type": "text", "text": _dumps(seg)}
+        except TypeError:
+            return {"type": "text", "text": str(seg)}
+    try:
+        return {"type": "text", "text": _dumps(segment)}
+    except TypeError:
+        return {"type": "text", "text": repr(segment)}
+
+
+def _tool_result_content(mcp_result: Any) -> List[Dict[str, Any]]:
+    """Convert a FastMCP CallToolResult into Claude tool_result text segments."""
+    content_segments = []
+    raw_content = getattr(mcp_result, "content", None)
+    if isinstance(raw_content, list):
+        for seg in raw_content:
+            content_segments.append(_to_text_segment(seg))
+
+    if not content_segments:
+        payload = getattr(mcp_result, "data", None) or getattr(mcp_result, "structured_content", None) or getattr(mcp_result, "content", None) or mcp_result
+        if isinstance(payload, str):
+            text_payload = payload
+        else:
+            try:
+                text_payload = _dumps(payload)
+            except TypeError:
+                text_payload = repr(payload)
+        content_segments = [{"type": "text", "text": text_payload}]
+    return content_segments
+
+
 async def ask_claude_with_mcp(chat_id: int, user_text: str) -> str:
     """
     1) Send user message + MCP tools to Claude.
@@ -209,10 +494,10 @@ async def ask_claude_with_mcp(chat_id: int, user_text: str) -> str:
     """
     tools = await mcp_bridge.claude_tool_schemas()
 
-    history = histories.get(chat_id, [])
+    history = await history_store.get(chat_id)
 
-    # append user turn
-    history = history + [{"role": "user", "content": user_text}]
+    # messages of the current turn; only committed to history once Claude answers
+    turn: List[Dict[str, Any]] = [{"role": "user", "content": user_text}]
 
     while True:
         kwargs = {
@@ -220,92 +505,82 @@ async def ask_claude_with_mcp(chat_id: int, user_text: str) -> str:
             "max_tokens": 10000,
             "tools": tools,
             # default tool_choice is auto :contentReference[oaicite:9]{index=9}
-            "tool_choice": {"type": "auto", "disable_parallel_tool_use": True},
-            "messages": history,
+            "tool_choice": {"type": "auto", "disable_parallel_tool_use": False},
+            "messages": [*history, *turn],
         }
         if SYSTEM_PROMPT:
             kwargs["system"] = SYSTEM_PROMPT
 
-        resp = anthropic_client.messages.create(**kwargs)
+        # Stream the response so each tool_use block is dispatched to MCP as soon as
+        # it closes, overlapping tool round trips with decoding of the remaining blocks.
+        tool_tasks: Dict[str, asyncio.Task] = {}
+        try:
+            async with anthropic_client.messages.stream(**kwargs) as stream:
+                async for event in stream:
+                    if event.type != "content_block_stop":
+                        continue
+                    block = _as_dict(event.content_block)
+                    if block["type"] != "tool_use":
+                        continue
+                    tool_args = block.get("input") or {}
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("Tool %s (id=%s) input: %s", block["name"], block["id"], _dumps(tool_args))
+                    # IMPORTANT: tool_args already includes {"input": {...}}
+                    tool_tasks[block["id"]] = asyncio.create_task(mcp_bridge.call_tool(block["name"], tool_args))
+                resp = await stream.get_final_message()
+        except BaseException:
+            for task in tool_tasks.values():
+                task.cancel()
+            raise
 
         # Claude returns content blocks; tool use stops with stop_reason=tool_use :contentReference[oaicite:10]{index=10}
         stop_reason = getattr(resp, "stop_reason", None)
-        content_blocks = resp.content
+        # Single pass over the dumped blocks: they go to history as-is while we
+        # collect text parts and tool_use calls for whichever branch follows.
+        assistant_content = []
+        text_parts = []
+        tool_uses = []
+        for cb in resp.content:
+            block = _as_dict(cb)
+            assistant_content.append(block)
+            if block["type"] == "text":
+                text_parts.append(block.get("text") or "")
+            elif block["type"] == "tool_use":
+                tool_uses.append(block)
 
         # Save assistant message to history
         assistant_msg = {
             "role": "assistant",
-            "content": [cb.model_dump() if hasattr(cb, "model_dump") else cb for cb in content_blocks],
+            "content": assistant_content,
         }
-        history.append(assistant_msg)
+        turn.append(assistant_msg)
 
         if stop_reason != "tool_use":
-            # gather all text blocks
-            texts = []
-            for cb in content_blocks:
-                cb_type = cb.type if hasattr(cb, "type") else cb.get("type")
-                if cb_type == "text":
-                    texts.append(cb.text if hasattr(cb, "text") else cb.get("text", ""))
-            final = "\n".join(texts).strip() or "(no text returned)"
-            histories[chat_id] = history[-20:]  # keep last N turns
-            return final
-
-        # Otherwise, execute all tool_use blocks
-        tool_results_blocks = []
-        for cb in content_blocks:
-            cb_type = cb.type if hasattr(cb, "type") else cb.get("type")
-            if cb_type != "tool_use":
-                continue
+            for task in tool_tasks.values():
+                task.cancel()
+            await history_store.put(chat_id, [*history, *turn])
+            return "\n".join(text_parts).strip() or "(no text returned)"
+
+        # Otherwise, wait for every tool_use block's call; results keep tool_use order
+        tool_calls = []
+        for block in tool_uses:
+            task = tool_tasks.get(block["id"])
+            if task is None:
+                task = asyncio.create_task(mcp_bridge.call_tool(block["name"], block.get("input") or {}))
+            tool_calls.append((block["name"], block["id"], task))
 
-            tool_name = cb.name if hasattr(cb, "name") else cb.get("name")
-            tool_args = cb.input if hasattr(cb, "input") else cb.get("input", {})
-            tool_use_id = cb.id if hasattr(cb, "id") else cb.get("id")
+        results = await asyncio.gather(*(task for _, _, task in tool_calls), return_exceptions=True)
 
+        tool_results_blocks = []
+        for (tool_name, tool_use_id, _), mcp_result in zip(tool_calls, results):
             try:
-                logger.info("Tool %s (id=%s) input: %s", tool_name, tool_use_id, json.dumps(tool_args, ensure_ascii=False))
-                # IMPORTANT: tool_args already includes {"input": {...}}
-                mcp_result = await mcp_bridge.call_tool(tool_name, tool_args)
+                if isinstance(mcp_result, BaseException):
+                    raise mcp_result
                 logger.info("Tool %s (id=%s) raw response: %r", tool_name, tool_use_id, mcp_result)
-
-                def _to_text_segment(segment: Any) -> Dict[str, Any]:
-                    if hasattr(segment, "model_dump"):
-                        segment = segment.model_dump()
-                    if isinstance(segment, dict):
-                        seg_type = segment.get("type")
-                        if seg_type == "text" and "text" in segment:
-                            return {"type": "text", "text": str(segment.get("text", ""))}
-                        try:
-                            return {"type": "text", "text": json.dumps(segment, ensure_ascii=False)}
-                        except TypeError:
-                            return {"type": "text", "text": str(segment)}
-                    if isinstance(segment, str):
-                        return {"type": "text", "text": segment}
-                    try:
-                        return {"type": "text", "text": json.dumps(segment, ensure_ascii=False)}
-                    except TypeError:
-                        return {"type": "text", "text": repr(segment)}
-
-                content_segments = []
-                raw_content = getattr(mcp_result, "content", None)
-                if isinstance(raw_content, list):
-                    for seg in raw_content:
-                        content_segments.append(_to_text_segment(seg))
-
-                if not content_segments:
-                    payload = getattr(mcp_result, "data", None) or getattr(mcp_result, "structured_content", None) or getattr(mcp_result, "content", None) or mcp_result
-                    if isinstance(payload, str):
-                        text_payload = payload
-                    else:
-                        try:
-                            text_payload = json.dumps(payload, ensure_ascii=False)
-                        except TypeError:
-                            text_payload = repr(payload)
-                    content_segments = [{"type": "text", "text": text_payload}]
-
                 tool_results_blocks.append({
                     "type": "tool_result",
                     "tool_use_id": tool_use_id,
-                    "content": content_segments,
+                    "content": _tool_result_content(mcp_result),
                     "is_error": False,
                 })
             except Exception as e:
@@ -316,7 +591,6 @@ async def ask_claude_with_mcp(chat_id: int, user_text: str) -> str:
                     "is_error": True,
                 })
 
-
         # Per Claude rules:
         # - tool_result blocks must immediately follow the assistant tool_use message
         # - tool_result blocks must come first in user content :contentReference[oaicite:11]{index=11}
@@ -324,7 +598,34 @@ async def ask_claude_with_mcp(chat_id: int, user_text: str) -> str:
             "role": "user",
             "content": tool_results_blocks,
         }
-        history.append(user_tool_msg)
+        turn.append(user_tool_msg)
+
+
+async def ask_claude_coalesced(chat_id: int, user_text: str) -> Optional[str]:
+    """
+    Merge a burst of messages from one chat into a single Claude turn.
+    The first message of a burst waits COALESCE_MS (plus any in-flight turn of the
+    chat), then sends everything queued so far and returns the answer. Messages that
+    joined an open burst return None; their text is answered by that burst's reply.
+    """
+    batch = pending_texts.get(chat_id)
+    if batch is not None:
+        batch.append(user_text)
+        return None
+
+    batch = pending_texts[chat_id] = [user_text]
+    try:
+        if COALESCE_MS > 0:
+            await asyncio.sleep(COALESCE_MS / 1000)
+        async with _chat_lock(chat_id):
+            # Close the burst; anything arriving from now on starts a new one.
+            pending_texts.pop(chat_id, None)
+            return await ask_claude_with_mcp(chat_id, "\n".join(batch))
+    finally:
+        # Never leave a stale burst behind (e.g. if we were cancelled while waiting).
+        if pending_texts.get(chat_id) is batch:
+            pending_texts.pop(chat_id, None)
+
 
 # -------------------------
 # Telegram long-polling bot
@@ -336,6 +637,19 @@ bot = Bot(
 )
 dp = Dispatcher()
 
+# updates still being handled, so shutdown can let them finish answering
+inflight_updates: Set[asyncio.Task] = set()
+
+
+@dp.update.outer_middleware()
+async def _track_inflight(handler, event, data):
+    task = asyncio.current_task()
+    inflight_updates.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        inflight_updates.discard(task)
+
 @dp.message(CommandStart())
 async def start_handler(message: types.Message):
     if not _is_user_allowed(message.from_user.id):
@@ -353,25 +667,71 @@ async def text_handler(message: types.Message):
         await message.reply("Sorry, this bot is restricted to authorized users.")
         return
     chat_id = message.chat.id
-    user_text = message.text.strip()
+    user_text = (message.text or "").strip()
+    if not user_text:
+        return  # stickers, media and other updates without text
+    if len(user_text) > MAX_USER_CHARS:
+        await message.reply(
+            f"Message too long ({len(user_text)} chars, max {MAX_USER_CHARS}). Please split it.",
+            parse_mode=None,
+        )
+        return
 
-    await message.chat.do("typing")
-
+    typing_task = asyncio.create_task(_keep_typing(message.chat))
     try:
-        answer = await ask_claude_with_mcp(chat_id, user_text)
+        answer = await ask_claude_coalesced(chat_id, user_text)
+        if answer is None:
+            return  # merged into an earlier message's turn
         await _safe_markdown_reply(message, answer)
     except Exception as e:
         logger.exception("Failed to create response for chat_id=%s", chat_id)
         await _safe_markdown_reply(message, f"Sorry, something went wrong:\n`{repr(e)}`")
+    finally:
+        typing_task.cancel()
+
+
+async def _drain_inflight_updates(timeout: float):
+    """Give in-flight updates up to `timeout` seconds to finish, then cancel the rest."""
+    pending = {task for task in inflight_updates if not task.done()}
+    if not pending:
+        return
+    logger.info("Waiting up to %.0fs for %d in-flight update(s)", timeout, len(pending))
+    _, still_running = await asyncio.wait(pending, timeout=timeout)
+    for task in still_running:
+        task.cancel()
+    await asyncio.gather(*still_running, return_exceptions=True)
 
 
 async def main():
+    await history_store.open()
     await mcp_bridge.connect()
+
+    # Stop on SIGTERM/SIGINT (docker stop, rolling deploys) and unwind cleanly.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # e.g. Windows event loops
+            pass
+
+    # Long polling loop; the bot session is closed below, after in-flight replies are sent. :contentReference[oaicite:12]{index=12}
+    polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    stop_task = asyncio.create_task(stop.wait())
     try:
-        # Long polling loop. :contentReference[oaicite:12]{index=12}
-        await dp.start_polling(bot)
+        await asyncio.wait({polling_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        if polling_task.done():
+            polling_task.result()  # surface polling errors
     finally:
+        # Stop taking new updates, let answers in progress finish, then release resources.
+        polling_task.cancel()
+        stop_task.cancel()
+        await asyncio.gather(polling_task, stop_task, return_exceptions=True)
+        await _drain_inflight_updates(SHUTDOWN_GRACE_SECONDS)
         await mcp_bridge.close()
+        await history_store.close()
+        await bot.session.close()
+        await anthropic_client.close()
 
 
 if __name__ == "__main__":
@@ -2,7 +2,11 @@
 import os
 import asyncio
 import logging
-from typing import Any, Dict, List, Optional, Set
+import signal
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Set
 
 from dotenv import load_dotenv
 
@@ -10,8 +14,9 @@ from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 
+import httpx
 from langchain.agents import create_agent
 from langchain_core.messages import HumanMessage
 from langchain_mcp_adapters.client import MultiServerMCPClient
@@ -52,6 +57,13 @@ NVIDIA_MODEL = _get_env("NVIDIA_MODEL", "qwen/qwen3-235b-a22b") or "qwen/qwen3-2
 SYSTEM_PROMPT = _get_env("OSS_SYSTEM_PROMPT") or prompts.OSS_SYSTEM_PROMPT.strip()
 TEMPERATURE = _parse_float(_get_env("OSS_TEMPERATURE"), 0.2)
 MAX_COMPLETION_TOKENS = _parse_int(_get_env("OSS_MAX_COMPLETION_TOKENS"), 10240)
+MAX_HISTORY = _parse_int(_get_env("MAX_HISTORY"), 20)
+HISTORY_LRU = _parse_int(_get_env("HISTORY_LRU"), 1024)
+MAX_USER_CHARS = _parse_int(_get_env("MAX_USER_CHARS"), 8000)
+# On SIGTERM, how long in-flight answers may finish before they are cancelled.
+SHUTDOWN_GRACE_SECONDS = _parse_float(_get_env("SHUTDOWN_GRACE_SECONDS"), 8.0)
+MCP_TOOLS_TTL_SECONDS = _parse_float(_get_env("MCP_TOOLS_TTL_SECONDS"), 300.0)
+OSS_WARMUP_LLM = _parse_int(_get_env("OSS_WARMUP_LLM"), 1) > 0
 _allowed_ids_raw = _get_env("TELEGRAM_ALLOWED_USER_IDS", "") or ""
 
 MCP_SERVER_URL = _get_env("MCP_SERVER_URL")
@@ -80,33 +92,57 @@ if not TELEGRAM_BOT_TOKEN or not NVIDIA_API_KEY or not MCP_SERVER_URL:
     raise RuntimeError("Missing required env vars. Check TELEGRAM_BOT_TOKEN, NVIDIA_API_KEY, MCP_SERVER_URL")
 
 
-def _parse_allowed_ids(raw: str) -> Set[int]:
-    ids: Set[int] = set()
-    if not raw:
-        return ids
-    for chunk in raw.split(","):
-        candidate = chunk.strip()
-        if not candidate:
-            continue
-        try:
-            ids.add(int(candidate))
-        except ValueError:
+def _parse_allowed_ids(raw: str) -> FrozenSet[int]:
+    candidates = [chunk.strip() for chunk in raw.split(",") if chunk.strip()]
+    valid = [c for c in candidates if c.removeprefix("-").isdecimal()]
+    for candidate in candidates:
+        if not candidate.removeprefix("-").isdecimal():
             logger.warning("Ignoring invalid TELEGRAM_ALLOWED_USER_IDS entry: %r", candidate)
-    return ids
+    return frozenset(int(c) for c in valid)
 
 
 ALLOWED_TELEGRAM_USER_IDS = _parse_allowed_ids(_allowed_ids_raw)
 
 
-def _is_user_allowed(user_id: int) -> bool:
-    return not ALLOWED_TELEGRAM_USER_IDS or user_id in ALLOWED_TELEGRAM_USER_IDS
+def _build_user_check(allowed: FrozenSet[int]) -> Callable[[int], bool]:
+    # Runs on every update: bind the frozenset's membership test directly.
+    if not allowed:
+        return lambda user_id: True
+    return allowed.__contains__
+
+
+_is_user_allowed = _build_user_check(ALLOWED_TELEGRAM_USER_IDS)
 
 # -------------------------
 # MCP bridge via LangChain
 # -------------------------
+# httpx's defaults (10 keep-alive / 100 total) starve under concurrent chats.
+HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=_parse_int(_get_env("HTTP_MAX_KEEPALIVE"), 64),
+    max_connections=_parse_int(_get_env("HTTP_MAX_CONNECTIONS"), 256),
+    keepalive_expiry=_parse_float(_get_env("HTTP_KEEPALIVE_EXPIRY"), 60.0),
+)
+
+
+def _mcp_http_client(
+    headers: Optional[Dict[str, str]] = None,
+    timeout: Optional[httpx.Timeout] = None,
+    auth: Optional[httpx.Auth] = None,
+) -> httpx.AsyncClient:
+    """httpx client factory for the MCP transport using the tuned HTTP_LIMITS pool."""
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout or httpx.Timeout(30.0, read=300.0),
+        auth=auth,
+        limits=HTTP_LIMITS,
+        follow_redirects=True,
+    )
+
+
 mcp_server_config: Dict[str, Any] = {
     "transport": "http",
     "url": MCP_SERVER_URL,
+    "httpx_client_factory": _mcp_http_client,
 }
 
 if MCP_AUTH:
@@ -129,32 +165,104 @@ llm = ChatNVIDIA(
 )
 
 class OSSAgentManager:
-    """Lazy-load the LangChain agent so we only fetch tools once."""
+    """Lazy-load the LangChain agent, rebuilding it when the MCP tool list expires."""
 
     def __init__(self):
         self._agent = None
+        self._tools = None
+        self._tools_expiry = 0.0
         self._lock = asyncio.Lock()
 
+    def _is_fresh(self) -> bool:
+        return self._agent is not None and time.monotonic() < self._tools_expiry
+
+    async def _load_tools(self):
+        if self._tools is None or time.monotonic() >= self._tools_expiry:
+            self._tools = await mcp_client.get_tools()
+            self._tools_expiry = time.monotonic() + MCP_TOOLS_TTL_SECONDS
+            logger.info("Loaded %s MCP tools", len(self._tools) if hasattr(self._tools, "__len__") else "unknown")
+        return self._tools
+
+    def _build_agent(self, tools):
+        return create_agent(
+            model=llm,
+            tools=tools,
+            system_prompt=SYSTEM_PROMPT,
+            debug=False,
+            name="finance_intel_mcp_agent",
+        )
+
     async def get_agent(self):
-        if self._agent is None:
+        if not self._is_fresh():
             async with self._lock:
-                if self._agent is None:
-                    tools = await mcp_client.get_tools()
-                    logger.info("Loaded %s MCP tools", len(tools) if hasattr(tools, "__len__") else "unknown")
-                    self._agent = create_agent(
-                        model=llm,
-                        tools=tools,
-                        system_prompt=SYSTEM_PROMPT,
-                        debug=False,
-                        name="finance_intel_mcp_agent",
-                    )
+                if not self._is_fresh():
+                    self._agent = self._build_agent(await self._load_tools())
         return self._agent
 
+    async def refresh(self):
+        """Drop the cached agent so the next call re-fetches MCP tools."""
+        async with self._lock:
+            self._agent = None
+            self._tools = None
+            self._tools_expiry = 0.0
+        return await self.get_agent()
+
+    async def warm(self):
+        """
+        Build the agent and, unless OSS_WARMUP_LLM=0, send one tiny request to NIM so
+        the first real question does not pay for tool listing or the TLS handshake.
+        """
+        agent = await self.get_agent()
+        if OSS_WARMUP_LLM:
+            try:
+                # Only the connection matters; max_tokens overrides the payload key so a
+                # reasoning model can't spend a full OSS_MAX_COMPLETION_TOKENS reply here.
+                await llm.bind(max_tokens=1).ainvoke("ping")
+            except Exception:
+                logger.warning("LLM warm-up request failed", exc_info=True)
+        return agent
+
 
 agent_manager = OSSAgentManager()
 
-# per-chat state (simple memory)
-histories: Dict[int, List[Any]] = {}
+# per-chat state (simple memory), trimmed to whole turns of at most MAX_HISTORY messages;
+# an LRU of the HISTORY_LRU most recently active chats, so idle chats are forgotten
+histories: "OrderedDict[int, List[Any]]" = OrderedDict()
+
+
+def _trim_history(history: List[Any]) -> List[Any]:
+    """
+    Keep the newest whole turns that fit in MAX_HISTORY, so the history never
+    starts with an orphaned ToolMessage or an AIMessage missing its tool results.
+    The latest turn is always kept, even when it alone is longer than the limit.
+    """
+    starts = [i for i, message in enumerate(history) if isinstance(message, HumanMessage)]
+    if not starts:
+        return []
+    cutoff = len(history) - MAX_HISTORY
+    return history[next((i for i in starts if i >= cutoff), starts[-1]):]
+
+# per-chat locks so turns from the same chat never interleave on its history;
+# weak values let idle chats' locks be garbage collected
+chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        chat_locks[chat_id] = lock
+    return lock
+
+
+async def _keep_typing(chat: types.Chat) -> None:
+    """Telegram hides the typing indicator after ~5s; refresh it until cancelled."""
+    while True:
+        try:
+            await chat.do("typing")
+        except Exception:
+            logger.debug("Failed to send typing action", exc_info=True)
+        await asyncio.sleep(4)
 
 
 async def _safe_markdown_reply(message: types.Message, text: str) -> types.Message:
@@ -172,16 +280,65 @@ async def _safe_markdown_reply(message: types.Message, text: str) -> types.Messa
         return await message.reply(text, parse_mode=None)
 
 
-async def ask_oss_with_mcp(chat_id: int, user_text: str) -> str:
+class _StatusMessage:
+    """
+    A single throttled status message that shows which tools the agent is running.
+    Edits are spaced at least STATUS_EDIT_INTERVAL seconds apart to stay well within
+    Telegram's rate limits; the message is deleted once the answer is ready.
+    """
+
+    STATUS_EDIT_INTERVAL = 2.0
+
+    def __init__(self, message: types.Message):
+        self._message = message
+        self._status: Optional[types.Message] = None
+        self._last_edit = 0.0
+
+    async def update(self, text: str):
+        now = time.monotonic()
+        if self._status is not None and now - self._last_edit < self.STATUS_EDIT_INTERVAL:
+            return
+        self._last_edit = now
+        # The status is cosmetic: flood control or network errors must not abort the answer.
+        try:
+            if self._status is None:
+                self._status = await self._message.reply(text, parse_mode=None)
+            else:
+                await self._status.edit_text(text, parse_mode=None)
+        except TelegramAPIError as exc:
+            logger.debug("Could not update status message: %s", exc)
+
+    async def clear(self):
+        if self._status is not None:
+            try:
+                await self._status.delete()
+            except TelegramAPIError as exc:
+                logger.debug("Could not delete status message: %s", exc)
+            self._status = None
+
+
+async def ask_oss_with_mcp(
+    chat_id: int,
+    user_text: str,
+    on_progress: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> str:
     """
     Send the user message to the LangChain agent backed by the OSS model and MCP tools.
-    Maintains a short per-chat history for context.
+    Maintains a short per-chat history for context. Graph events are streamed so
+    `on_progress` can report tool calls while the agent is still running.
     """
     agent = await agent_manager.get_agent()
     history = histories.get(chat_id, [])
 
-    inputs = {"messages": history + [HumanMessage(content=user_text)]}
-    result_state = await agent.ainvoke(inputs)
+    inputs = {"messages": [*history, HumanMessage(content=user_text)]}
+    result_state = None
+    async for event in agent.astream_events(inputs, version="v2"):
+        kind = event["event"]
+        if kind == "on_tool_start" and on_progress is not None:
+            await on_progress(f"Running {event['name']}...")
+        elif kind == "on_chain_end" and not event.get("parent_ids"):
+            # The root run's output is the final graph state.
+            result_state = event["data"].get("output")
 
     messages = result_state["messages"] if isinstance(result_state, dict) else result_state
     if not isinstance(messages, list):
@@ -202,7 +359,11 @@ async def ask_oss_with_mcp(chat_id: int, user_text: str) -> str:
                     final_answer = text
                     break
 
-    histories[chat_id] = messages[-20:]  # keep last N turns
+    # The agent state echoes back our inputs first; only append what is new.
+    histories[chat_id] = _trim_history([*history, *messages[len(history):]])
+    histories.move_to_end(chat_id)
+    while len(histories) > HISTORY_LRU:
+        histories.popitem(last=False)
     return final_answer
 
 
@@ -216,6 +377,19 @@ bot = Bot(
 )
 dp = Dispatcher()
 
+# updates still being handled, so shutdown can let them finish answering
+inflight_updates: Set[asyncio.Task] = set()
+
+
+@dp.update.outer_middleware()
+async def _track_inflight(handler, event, data):
+    task = asyncio.current_task()
+    inflight_updates.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        inflight_updates.discard(task)
+
 
 @dp.message(CommandStart())
 async def start_handler(message: types.Message):
@@ -235,23 +409,70 @@ async def text_handler(message: types.Message):
         await message.reply("Sorry, this bot is restricted to authorized users.")
         return
     chat_id = message.chat.id
-    user_text = message.text.strip()
-
-    await message.chat.do("typing")
+    user_text = (message.text or "").strip()
+    if not user_text:
+        return  # stickers, media and other updates without text
+    if len(user_text) > MAX_USER_CHARS:
+        await message.reply(
+            f"Message too long ({len(user_text)} chars, max {MAX_USER_CHARS}). Please split it.",
+            parse_mode=None,
+        )
+        return
 
+    typing_task = asyncio.create_task(_keep_typing(message.chat))
+    status = _StatusMessage(message)
     try:
-        answer = await ask_oss_with_mcp(chat_id, user_text)
+        async with _chat_lock(chat_id):
+            answer = await ask_oss_with_mcp(chat_id, user_text, on_progress=status.update)
+        await status.clear()
         await _safe_markdown_reply(message, answer)
     except Exception as e:
         logger.exception("Failed to create response for chat_id=%s", chat_id)
+        await status.clear()
         await _safe_markdown_reply(message, f"Sorry, something went wrong:\n`{repr(e)}`")
+    finally:
+        typing_task.cancel()
+
+
+async def _drain_inflight_updates(timeout: float):
+    """Give in-flight updates up to `timeout` seconds to finish, then cancel the rest."""
+    pending = {task for task in inflight_updates if not task.done()}
+    if not pending:
+        return
+    logger.info("Waiting up to %.0fs for %d in-flight update(s)", timeout, len(pending))
+    _, still_running = await asyncio.wait(pending, timeout=timeout)
+    for task in still_running:
+        task.cancel()
+    await asyncio.gather(*still_running, return_exceptions=True)
 
 
 async def main():
     # Build agent up front so we fail fast if tools/model are unavailable.
-    await agent_manager.get_agent()
-    # Long polling loop.
-    await dp.start_polling(bot)
+    await agent_manager.warm()
+
+    # Stop on SIGTERM/SIGINT (docker stop, rolling deploys) and unwind cleanly.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # e.g. Windows event loops
+            pass
+
+    # Long polling loop; the bot session is closed below, after in-flight replies are sent.
+    polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    stop_task = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({polling_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        if polling_task.done():
+            polling_task.result()  # surface polling errors
+    finally:
+        # Stop taking new updates, let answers in progress finish, then release resources.
+        polling_task.cancel()
+        stop_task.cancel()
+        await asyncio.gather(polling_task, stop_task, return_exceptions=True)
+        await _drain_inflight_updates(SHUTDOWN_GRACE_SECONDS)
+        await bot.session.close()
 
 
 if __name__ == "__main__":
@@ -3,13 +3,22 @@ import asyncio
 import json
 import os
 import logging
-from typing import Any, Dict, List, Optional
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
 
 from dotenv import load_dotenv
 
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 
+import aiosqlite
+import httpx
+import orjson
 from fastmcp import Client  # FastMCP client
+from fastmcp.client.transports import SSETransport, StreamableHttpTransport
+from fastmcp.exceptions import ToolError
 
 
 load_dotenv()
@@ -22,15 +31,66 @@ def _get_env(key: str, default: Optional[str] = None) -> Optional[str]:
     return value.strip()
 
 
+def _parse_float(raw: Optional[str], default: float) -> float:
+    try:
+        return float(raw) if raw not in (None, "") else default
+    except ValueError:
+        return default
+
+
+def _parse_int(raw: Optional[str], default: int) -> int:
+    try:
+        return int(raw) if raw not in (None, "") else default
+    except ValueError:
+        return default
+
+
 LOG_LEVEL = (_get_env("LOG_LEVEL", "INFO") or "INFO").upper()
 logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO))
 logger = logging.getLogger(__name__)
 
 ANTHROPIC_API_KEY = _get_env("ANTHROPIC_API_KEY")
 CLAUDE_MODEL = _get_env("CLAUDE_MODEL", "claude-sonnet-4-5") or "claude-sonnet-4-5"
+# Analytical prompts go to the smart model, everything else to the faster one.
+CLAUDE_MODEL_SMART = _get_env("CLAUDE_MODEL_SMART") or CLAUDE_MODEL
+CLAUDE_MODEL_FAST = _get_env("CLAUDE_MODEL_FAST", "claude-haiku-4-5") or "claude-haiku-4-5"
 SYSTEM_PROMPT = _get_env("SYSTEM_PROMPT") or ""
+PARALLEL_TOOLS_PROMPT = (
+    "When several tool calls don't depend on each other's results, issue them together "
+    "in the same turn; they run in parallel."
+)
+# Prompt-cache lifetime for tools/system/conversation prefix: "5m" (default) or "1h".
+CLAUDE_CACHE_TTL = _get_env("CLAUDE_CACHE_TTL", "5m") or "5m"
+CACHE_CONTROL = {"type": "ephemeral", "ttl": CLAUDE_CACHE_TTL}
+# Interactive mode only: write the tools/system prefix to the prompt cache before the first prompt.
+CLAUDE_CACHE_WARMUP = _parse_int(_get_env("CLAUDE_CACHE_WARMUP"), 0) > 0
+SYSTEM_BLOCKS = [{
+    "type": "text",
+    "text": f"{SYSTEM_PROMPT}\n\n{PARALLEL_TOOLS_PROMPT}" if SYSTEM_PROMPT else PARALLEL_TOOLS_PROMPT,
+    "cache_control": CACHE_CONTROL,
+}]
 
 MCP_SERVER_URL = _get_env("MCP_SERVER_URL")
+MCP_TOOLS_TTL_SECONDS = _parse_float(_get_env("MCP_TOOLS_TTL_SECONDS"), 300.0)
+# Seconds a successful tool result is reused for identical arguments; prices go stale fastest.
+TOOL_CACHE_TTLS = {"quote": 5.0, "timeseries": 60.0, "analyze_asset": 60.0}
+TOOL_CACHE_DEFAULT_TTL = 30.0
+TOOL_CACHE_SIZE = 512
+# Transient connection failures are retried with jittered backoff; a tool that keeps
+# failing is short-circuited for a while so every call doesn't wait out the timeout.
+MCP_RETRY_ATTEMPTS = 3
+MCP_BREAKER_FAIL_MAX = 5
+MCP_BREAKER_RESET_SECONDS = 30.0
+MAX_SESSIONS = _parse_int(_get_env("MAX_SESSIONS"), 1000)
+MAX_HISTORY_TOKENS = _parse_int(_get_env("MAX_HISTORY_TOKENS"), 50000)
+SESSION_DB_PATH = _get_env("SESSION_DB_PATH") or ""
+SESSION_RETENTION_DAYS = _parse_float(_get_env("SESSION_RETENTION_DAYS"), 30.0)
+
+HTTP_LIMITS = httpx.Limits(
+    max_connections=_parse_int(_get_env("HTTP_MAX_CONNECTIONS"), 256),
+    max_keepalive_connections=_parse_int(_get_env("HTTP_MAX_KEEPALIVE"), 64),
+    keepalive_expiry=_parse_float(_get_env("HTTP_KEEPALIVE_EXPIRY"), 60.0),
+)
 
 
 def _normalize_mcp_auth(raw_auth: Optional[str]) -> Optional[str]:
@@ -56,18 +116,73 @@ if not ANTHROPIC_API_KEY or not MCP_SERVER_URL:
     raise RuntimeError("Missing required env vars. Check ANTHROPIC_API_KEY and MCP_SERVER_URL")
 
 
+_JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "array": list,
+    "object": dict,
+    "null": type(None),
+}
+
+
+def _matches_json_type(value: Any, type_name: str) -> bool:
+    # bool is an int subclass, but JSON keeps booleans and numbers apart.
+    if isinstance(value, bool):
+        return type_name == "boolean"
+    return isinstance(value, _JSON_TYPES[type_name])
+
+
+def _mcp_http_client(
+    headers: Optional[Dict[str, str]] = None,
+    timeout: Optional[httpx.Timeout] = None,
+    auth: Optional[httpx.Auth] = None,
+) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout or httpx.Timeout(30.0, read=300.0),
+        auth=auth,
+        limits=HTTP_LIMITS,
+        follow_redirects=True,
+    )
+
+
+def _tool_extractor(sample: Any):
+    """Pick a (name, description, input_schema) getter for the shape list_tools returns."""
+    if isinstance(sample, dict):
+        return lambda t: (t.get("name"), t.get("description") or "", t.get("inputSchema") or t.get("input_schema") or {})
+    return lambda t: (t.name, t.description or "", t.inputSchema or {})
+
+
+class ToolUnavailableError(RuntimeError):
+    pass
+
+
 class MCPBridge:
     def __init__(self, url: str, auth: Optional[str] = None):
         self.url = url
         self.auth = auth
-        self.client = Client(url, auth=auth) if auth else Client(url)
+        transport_cls = SSETransport if url.rstrip("/").endswith("/sse") else StreamableHttpTransport
+        self.client = Client(transport_cls(url, auth=auth, httpx_client_factory=_mcp_http_client))
         self._connected = False
         self._cached_tools = None  # list[mcp.types.Tool]
+        self._cached_schemas: Optional[List[Dict[str, Any]]] = None
+        self._input_schemas: Dict[str, Dict[str, Any]] = {}
+        self._schemas_ts = 0.0
+        self._extract = None  # (name, description, input_schema) getter, picked on first list
+        # (name, sorted-args JSON) -> (expires_at, result), oldest first.
+        self._tool_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # tool name -> (consecutive failures, monotonic time the breaker last opened)
+        self._breakers: Dict[str, tuple] = {}
+        self._inflight: Dict[tuple, asyncio.Future] = {}
 
     async def connect(self):
         if not self._connected:
             await self.client.__aenter__()
             self._connected = True
+            # Build schemas now so the first prompt doesn't pay for list_tools.
+            await self.claude_tool_schemas()
 
     async def close(self):
         if self._connected:
@@ -78,160 +193,401 @@ class MCPBridge:
         self._cached_tools = await self.client.list_tools()
         return self._cached_tools
 
-    async def call_tool(self, name: str, arguments: Dict[str, Any]):
-        return await self.client.call_tool(name, arguments)
+    async def call_tool(self, name: str, arguments: Dict[str, Any], no_cache: bool = False):
+        key = (name, orjson.dumps(arguments, option=orjson.OPT_SORT_KEYS))
+        if not no_cache:
+            cached = self._tool_cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+
+        # Single flight: concurrent identical calls share one request to the server.
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = asyncio.get_running_loop().create_future()
+        self._inflight[key] = pending
+        try:
+            result = await self._call_and_cache(name, arguments, key)
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as exc:
+            # The server-side tool list changed under us; refetch on the next turn.
+            if "unknown tool" in str(exc).lower():
+                self.invalidate_tools()
+            pending.set_exception(exc)
+            pending.exception()  # retrieved here, so no warning when nobody else was waiting
+            raise
+        else:
+            pending.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
 
-    async def claude_tool_schemas_old(self):
-        tools = await self.list_tools()
-        schemas = []
-        for t in tools:
-            name = getattr(t, "name", None)
-            desc = getattr(t, "description", "") or ""
-            input_schema = (
-                getattr(t, "input_schema", None)
-                or getattr(t, "inputSchema", None)
-                or {}
-            )
-            if not name:
+    async def _call_and_cache(self, name: str, arguments: Dict[str, Any], key: tuple):
+        failures, opened_at = self._breakers.get(name, (0, 0.0))
+        if failures >= MCP_BREAKER_FAIL_MAX and time.monotonic() - opened_at < MCP_BREAKER_RESET_SECONDS:
+            raise ToolUnavailableError(f"MCP tool {name!r} is temporarily unavailable, try again later.")
+
+        try:
+            result = await self._call_with_retry(name, arguments)
+        except ToolError:
+            # The tool ran and reported an error; the server itself is fine.
+            raise
+        except Exception:
+            # Re-read: parallel calls to the same tool may have failed meanwhile.
+            failures, opened_at = self._breakers.get(name, (0, 0.0))
+            failures += 1
+            self._breakers[name] = (failures, time.monotonic() if failures >= MCP_BREAKER_FAIL_MAX else opened_at)
+            if failures == MCP_BREAKER_FAIL_MAX:
+                logger.warning("MCP tool %s failed %d times in a row, pausing it for %.0fs", name, failures, MCP_BREAKER_RESET_SECONDS)
+            raise
+        self._breakers.pop(name, None)
+
+        ttl = TOOL_CACHE_TTLS.get(name, TOOL_CACHE_DEFAULT_TTL)
+        if ttl > 0:
+            self._tool_cache[key] = (time.monotonic() + ttl, result)
+            self._tool_cache.move_to_end(key)
+            while len(self._tool_cache) > TOOL_CACHE_SIZE:
+                self._tool_cache.popitem(last=False)
+        return result
+
+    async def _call_with_retry(self, name: str, arguments: Dict[str, Any]):
+        for attempt in range(1, MCP_RETRY_ATTEMPTS + 1):
+            try:
+                return await self.client.call_tool(name, arguments)
+            except (httpx.ConnectError, httpx.TimeoutException, TimeoutError) as exc:
+                if attempt == MCP_RETRY_ATTEMPTS:
+                    raise
+                delay = min(2.0, 0.2 * 2 ** (attempt - 1) + random.uniform(0, 0.2))
+                logger.warning("MCP tool %s attempt %d failed (%r), retrying in %.2fs", name, attempt, exc, delay)
+                await asyncio.sleep(delay)
+
+    def check_arguments(self, name: str, arguments: Any) -> Optional[str]:
+        """
+        Shallow check of a tool call against its input schema. Returns a message
+        Claude can act on, or None when the call looks valid.
+        """
+        schema = self._input_schemas.get(name)
+        if schema is None:
+            # Claude may know a tool our cached list doesn't; refetch on the next turn.
+            self.invalidate_tools()
+            return f"Unknown tool {name!r}."
+        if not isinstance(arguments, dict):
+            return f"Arguments for {name!r} must be an object."
+        missing = [key for key in schema.get("required", ()) if key not in arguments]
+        if missing:
+            return f"Missing required argument(s) for {name!r}: {', '.join(missing)}."
+        properties = schema.get("properties") or {}
+        for key, value in arguments.items():
+            declared = (properties.get(key) or {}).get("type")
+            # Type lists (["object", "null"]) accept any listed type; skip anything else unusual.
+            names = declared if isinstance(declared, list) else [declared]
+            if value is None or not names or not all(isinstance(n, str) and n in _JSON_TYPES for n in names):
                 continue
+            if not any(_matches_json_type(value, n) for n in names):
+                return f"Argument {key!r} for {name!r} must be of type {' or '.join(names)}."
+        return None
 
-            schemas.append(
-                {
-                    "name": name,
-                    "description": desc,
-                    "input_schema": input_schema,
-                }
-            )
-        return schemas
+    def invalidate_tools(self):
+        self._cached_schemas = None
+        self._schemas_ts = 0.0
 
     async def claude_tool_schemas(self):
+        if self._cached_schemas is not None and time.monotonic() - self._schemas_ts < MCP_TOOLS_TTL_SECONDS:
+            return self._cached_schemas
+
         tools = await self.list_tools()
-        schemas = []
-
-        for t in tools:
-            name = getattr(t, "name", None) or t.get("name")
-            desc = getattr(t, "description", "") or t.get("description", "")
-
-            input_schema = (
-                getattr(t, "inputSchema", None)
-                or getattr(t, "input_schema", None)
-                or t.get("inputSchema")
-                or t.get("input_schema")
-                or {}
+        if tools and self._extract is None:
+            self._extract = _tool_extractor(tools[0])
+        schemas = [
+            {"name": name, "description": desc, "input_schema": input_schema}   # NOTE: keep wrapper "input"
+            for name, desc, input_schema in map(self._extract, tools)
+            if name
+        ]
+
+        self._input_schemas = {schema["name"]: schema["input_schema"] for schema in schemas}
+        if schemas:
+            # A breakpoint on the last tool caches the whole tool list.
+            schemas[-1]["cache_control"] = CACHE_CONTROL
+        self._cached_schemas = schemas
+        self._schemas_ts = time.monotonic()
+        return schemas
+
+
+mcp_bridge = MCPBridge(MCP_SERVER_URL, MCP_AUTH)
+
+anthropic_client = AsyncAnthropic(
+    api_key=ANTHROPIC_API_KEY,
+    http_client=httpx.AsyncClient(limits=HTTP_LIMITS, timeout=httpx.Timeout(120.0, connect=10.0)),
+)
+
+
+def _starts_turn(message: Dict[str, Any]) -> bool:
+    # A plain user prompt; tool_result messages can't lead because their tool_use would be gone.
+    return message["role"] == "user" and isinstance(message["content"], str)
+
+
+def _trim_history(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Keep the newest whole turns of at most 20 messages that fit MAX_HISTORY_TOKENS
+    (estimated as 4 chars per token). The latest turn is always kept.
+    """
+    starts = [i for i, message in enumerate(history) if _starts_turn(message)]
+    if not starts:
+        return []
+    # Turn starts are found over the whole list: one turn can be longer than 20 messages.
+    cutoff = len(history) - 20
+    history = history[next((i for i in starts if i >= cutoff), starts[-1]):]
+    sizes = [len(json.dumps(m, ensure_ascii=False, default=str)) // 4 for m in history]
+    remaining = sum(sizes)
+    fallback = None
+    for i, message in enumerate(history):
+        if _starts_turn(message):
+            if remaining <= MAX_HISTORY_TOKENS:
+                return history[i:]
+            fallback = i
+        remaining -= sizes[i]
+    return history[fallback:] if fallback is not None else []
+
+
+class SessionStore:
+    """
+    Session histories: an in-RAM LRU of the MAX_SESSIONS most recently used
+    sessions, optionally backed by SQLite (SESSION_DB_PATH) so a session can be
+    resumed after the CLI exits.
+    """
+
+    def __init__(self, db_path: str = "", lru_size: int = 1000, retention_days: float = 30.0):
+        self.db_path = db_path
+        self.lru_size = lru_size
+        self.retention_days = retention_days
+        self._cache: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._db = None
+
+    async def open(self):
+        if not self.db_path or self._db is not None:
+            return
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, history_json BLOB NOT NULL, updated_at INTEGER NOT NULL)"
+        )
+        await self._db.commit()
+        await self._vacuum()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def _vacuum(self):
+        # Drop sessions idle past the retention window and give their pages back to the OS.
+        if self.retention_days <= 0:
+            return
+        cutoff = int(time.time() - self.retention_days * 86400)
+        cur = await self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+        await self._db.commit()
+        if cur.rowcount > 0:
+            logger.info("Removed %d expired session(s)", cur.rowcount)
+            await self._db.execute("VACUUM")
+
+    async def get(self, session_id: str) -> List[Dict[str, Any]]:
+        history = self._cache.get(session_id)
+        if history is not None:
+            self._cache.move_to_end(session_id)
+            return history
+
+        history = []
+        if self._db is not None:
+            async with self._db.execute(
+                "SELECT history_json FROM sessions WHERE session_id = ?", (session_id,)
+            ) as cur:
+                row = await cur.fetchone()
+            if row:
+                history = orjson.loads(row[0])
+        self._remember(session_id, history)
+        return history
+
+    async def put(self, session_id: str, history: List[Dict[str, Any]]):
+        history = _trim_history(history)
+        self._remember(session_id, history)
+        if self._db is not None:
+            await self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, history_json, updated_at) VALUES (?, ?, ?)",
+                (session_id, orjson.dumps(history), int(time.time())),
             )
+            await self._db.commit()
 
-            if not name:
-                continue
+    def _remember(self, session_id: str, history: List[Dict[str, Any]]):
+        self._cache[session_id] = history
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.lru_size:
+            self._cache.popitem(last=False)
 
-            schemas.append({
-                "name": name,
-                "description": desc,
-                "input_schema": input_schema,   # NOTE: keep wrapper "input"
-            })
 
-        return schemas
+session_store = SessionStore(SESSION_DB_PATH, MAX_SESSIONS, SESSION_RETENTION_DAYS)
 
 
-mcp_bridge = MCPBridge(MCP_SERVER_URL, MCP_AUTH)
+def _dumps(obj: Any) -> str:
+    # orjson always emits UTF-8 (same as ensure_ascii=False); its encode error is a TypeError.
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _to_text_segment(segment: Any) -> Dict[str, Any]:
+    # Fast path: TextContent already carries the string, skip the model_dump round-trip.
+    text = getattr(segment, "text", None)
+    if isinstance(text, str) and getattr(segment, "type", None) == "text":
+        return {"type": "text", "text": text}
+    if hasattr(segment, "model_dump"):
+        segment = segment.model_dump()
+    if isinstance(segment, dict):
+        seg_type = segment.get("type")
+        if seg_type == "text" and "text" in segment:
+            return {"type": "text", "text": str(segment.get("text", ""))}
+        try:
+            return {"type": "text", "text": _dumps(segment)}
+        except TypeError:
+            return {"type": "text", "text": str(segment)}
+    if isinstance(segment, str):
+        return {"type": "text", "text": segment}
+    try:
+        return {"type": "text", "text": _dumps(segment)}
+    except TypeError:
+        return {"type": "text", "text": repr(segment)}
+
+
+def _tool_result_content(mcp_result: Any) -> List[Dict[str, Any]]:
+    raw_content = getattr(mcp_result, "content", None)
+    content_segments = list(map(_to_text_segment, raw_content)) if isinstance(raw_content, list) else []
+
+    if not content_segments:
+        payload = getattr(mcp_result, "data", None) or getattr(mcp_result, "structured_content", None) or getattr(mcp_result, "content", None) or mcp_result
+        if isinstance(payload, str):
+            text_payload = payload
+        else:
+            try:
+                text_payload = _dumps(payload)
+            except TypeError:
+                text_payload = repr(payload)
+        content_segments = [{"type": "text", "text": text_payload}]
+    return content_segments
+
 
-anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+_ANALYSIS_RE = re.compile(
+    r"\b(analy[sz]|trend|risk|chart|compar|forecast|predict|outlook|strateg|volatil|correlat|portfolio|backtest)",
+    re.IGNORECASE,
+)
 
-histories: Dict[str, List[Dict[str, Any]]] = {}
 
+def _pick_model(user_text: str) -> str:
+    return CLAUDE_MODEL_SMART if _ANALYSIS_RE.search(user_text) else CLAUDE_MODEL_FAST
 
-async def ask_claude_with_mcp(session_id: str, user_text: str) -> str:
+
+def _with_cache_breakpoint(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Return messages with a cache breakpoint on the last block of the newest message,
+    so the next request reuses the conversation prefix. History itself stays unmarked
+    because Anthropic allows only four breakpoints per request.
+    """
+    if not messages:
+        return messages
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [*content[:-1], {**content[-1], "cache_control": CACHE_CONTROL}]
+    return [*messages[:-1], {**last, "content": content}]
+
+
+async def _call_tool_checked(name: str, arguments: Any, tool_use_id: str):
+    # Rejected here, a bad call fails alone instead of reaching the server.
+    problem = mcp_bridge.check_arguments(name, arguments)
+    if problem is not None:
+        raise ValueError(problem)
+    started = time.perf_counter()
+    try:
+        return await mcp_bridge.call_tool(name, arguments)
+    finally:
+        logger.info("Tool %s (id=%s) took %.3fs", name, tool_use_id, time.perf_counter() - started)
+
+
+async def ask_claude_with_mcp(
+    session_id: str,
+    user_text: str,
+    on_text: Optional[Callable[[str], None]] = None,
+) -> str:
     tools = await mcp_bridge.claude_tool_schemas()
 
-    history = histories.get(session_id, [])
+    history = await session_store.get(session_id)
 
     history = history + [{"role": "user", "content": user_text}]
 
-    while True:
-        kwargs = {
-            "model": CLAUDE_MODEL,
-            "max_tokens": 10000,
-            "tools": tools,
-            "tool_choice": {"type": "auto", "disable_parallel_tool_use": True},
-            "messages": history,
-        }
-        if SYSTEM_PROMPT:
-            kwargs["system"] = SYSTEM_PROMPT
+    base_kwargs = {
+        "model": _pick_model(user_text),
+        "max_tokens": 10000,
+        "tools": tools,
+        "tool_choice": {"type": "auto", "disable_parallel_tool_use": False},
+        "system": SYSTEM_BLOCKS,
+    }
 
-        resp = anthropic_client.messages.create(**kwargs)
+    while True:
+        streamed = False
+        async with anthropic_client.messages.stream(messages=_with_cache_breakpoint(history), **base_kwargs) as stream:
+            async for text in stream.text_stream:
+                if on_text is not None:
+                    on_text(text)
+                    streamed = True
+            resp = await stream.get_final_message()
 
         stop_reason = getattr(resp, "stop_reason", None)
-        content_blocks = resp.content
+        if streamed and stop_reason == "tool_use":
+            on_text("\n")
+        # One dump of the whole response; history keeps these dicts and the scans below reuse them.
+        content_blocks = resp.model_dump(mode="json")["content"]
 
         assistant_msg = {
             "role": "assistant",
-            "content": [cb.model_dump() if hasattr(cb, "model_dump") else cb for cb in content_blocks],
+            "content": content_blocks,
         }
         history.append(assistant_msg)
 
         if stop_reason != "tool_use":
-            texts = []
-            for cb in content_blocks:
-                cb_type = cb.type if hasattr(cb, "type") else cb.get("type")
-                if cb_type == "text":
-                    texts.append(cb.text if hasattr(cb, "text") else cb.get("text", ""))
+            texts = [cb.get("text", "") for cb in content_blocks if cb["type"] == "text"]
             final = "\n".join(texts).strip() or "(no text returned)"
-            histories[session_id] = history[-20:]
+            if on_text is not None and not texts:
+                on_text(final)
+            await session_store.put(session_id, history)
             return final
 
-        tool_results_blocks = []
+        tool_uses = []
         for cb in content_blocks:
-            cb_type = cb.type if hasattr(cb, "type") else cb.get("type")
-            if cb_type != "tool_use":
+            if cb["type"] != "tool_use":
                 continue
 
-            tool_name = cb.name if hasattr(cb, "name") else cb.get("name")
-            tool_args = cb.input if hasattr(cb, "input") else cb.get("input", {})
-            tool_use_id = cb.id if hasattr(cb, "id") else cb.get("id")
+            tool_name = cb["name"]
+            tool_args = cb.get("input") or {}
+            tool_use_id = cb["id"]
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Tool %s (id=%s) input: %s", tool_name, tool_use_id, _dumps(tool_args))
+            tool_uses.append((tool_name, tool_args, tool_use_id))
 
-            try:
-                logger.info("Tool %s (id=%s) input: %s", tool_name, tool_use_id, json.dumps(tool_args, ensure_ascii=False))
-                mcp_result = await mcp_bridge.call_tool(tool_name, tool_args)
-                logger.info("Tool %s (id=%s) raw response: %r", tool_name, tool_use_id, mcp_result)
-
-                def _to_text_segment(segment: Any) -> Dict[str, Any]:
-                    if hasattr(segment, "model_dump"):
-                        segment = segment.model_dump()
-                    if isinstance(segment, dict):
-                        seg_type = segment.get("type")
-                        if seg_type == "text" and "text" in segment:
-                            return {"type": "text", "text": str(segment.get("text", ""))}
-                        try:
-                            return {"type": "text", "text": json.dumps(segment, ensure_ascii=False)}
-                        except TypeError:
-                            return {"type": "text", "text": str(segment)}
-                    if isinstance(segment, str):
-                        return {"type": "text", "text": segment}
-                    try:
-                        return {"type": "text", "text": json.dumps(segment, ensure_ascii=False)}
-                    except TypeError:
-                        return {"type": "text", "text": repr(segment)}
-
-                content_segments = []
-                raw_content = getattr(mcp_result, "content", None)
-                if isinstance(raw_content, list):
-                    for seg in raw_content:
-                        content_segments.append(_to_text_segment(seg))
-
-                if not content_segments:
-                    payload = getattr(mcp_result, "data", None) or getattr(mcp_result, "structured_content", None) or getattr(mcp_result, "content", None) or mcp_result
-                    if isinstance(payload, str):
-                        text_payload = payload
-                    else:
-                        try:
-                            text_payload = json.dumps(payload, ensure_ascii=False)
-                        except TypeError:
-                            text_payload = repr(payload)
-                    content_segments = [{"type": "text", "text": text_payload}]
+        results = await asyncio.gather(
+            *(_call_tool_checked(*tool_use) for tool_use in tool_uses),
+            return_exceptions=True,
+        )
 
+        tool_results_blocks = []
+        for (tool_name, _, tool_use_id), mcp_result in zip(tool_uses, results):
+            try:
+                if isinstance(mcp_result, BaseException):
+                    raise mcp_result
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Tool %s (id=%s) raw response: %r", tool_name, tool_use_id, mcp_result)
                 tool_results_blocks.append({
                     "type": "tool_result",
                     "tool_use_id": tool_use_id,
-                    "content": content_segments,
+                    "content": _tool_result_content(mcp_result),
                     "is_error": False,
                 })
             except Exception as e:
@@ -250,9 +606,34 @@ async def ask_claude_with_mcp(session_id: str, user_text: str) -> str:
         )
 
 
+async def _prime_prompt_cache() -> None:
+    """One-token request per routed model so the first real prompt reads the cached prefix."""
+    tools = await mcp_bridge.claude_tool_schemas()
+    results = await asyncio.gather(
+        *(
+            anthropic_client.messages.create(
+                model=model,
+                max_tokens=1,
+                tools=tools,
+                system=SYSTEM_BLOCKS,
+                messages=[{"role": "user", "content": "ping"}],
+            )
+            for model in {CLAUDE_MODEL_FAST, CLAUDE_MODEL_SMART}
+        ),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.warning("Prompt cache warmup failed: %r", result)
+
+
+def _print_stream(text: str) -> None:
+    print(text, end="", flush=True)
+
+
 async def run_single(session_id: str, prompt: str) -> None:
-    answer = await ask_claude_with_mcp(session_id, prompt)
-    print(answer)
+    await ask_claude_with_mcp(session_id, prompt, on_text=_print_stream)
+    print()
 
 
 async def run_interactive(session_id: str) -> None:
@@ -267,12 +648,12 @@ async def run_interactive(session_id: str) -> None:
             continue
         if user_text.lower() in {"exit", "quit"}:
             break
-        print("Claude is thinking...")
+        print("Claude: ", end="", flush=True)
         try:
-            answer = await ask_claude_with_mcp(session_id, user_text)
-            print(f"Claude: {answer}\n")
+            await ask_claude_with_mcp(session_id, user_text, on_text=_print_stream)
+            print("\n")
         except Exception as exc:
-            print(f"Error: {exc}")
+            print(f"\nError: {exc}")
     print("Session ended.")
 
 
@@ -282,14 +663,20 @@ async def main():
     parser.add_argument("--session", default="cli", help="Optional session id for maintaining conversation context.")
     args = parser.parse_args()
 
+    await session_store.open()
+    # connect() also fetches the tool schemas, so the first prompt doesn't wait for list_tools.
     await mcp_bridge.connect()
     try:
         if args.prompt:
             await run_single(args.session, args.prompt.strip())
         else:
+            if CLAUDE_CACHE_WARMUP:
+                await _prime_prompt_cache()
             await run_interactive(args.session)
     finally:
         await mcp_bridge.close()
+        await anthropic_client.close()
+        await session_store.close()
 
 
 if __name__ == "__main__":